@@ -1,15 +1,27 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, ValidationError, create_model
-from typing import Optional, List, Union, Dict, Any
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, create_model
+from typing import Optional, List, Union, Dict, Any, Final
+import orjson
 import uvicorn
 from pydantic_ai import Agent
+from pydantic_ai.models.openai import OpenAIModel
+from pydantic_ai.models.anthropic import AnthropicModel
+from pydantic_ai.models.gemini import GeminiModel
+from functools import lru_cache
+from collections import defaultdict, deque
+import re
+import asyncio
+import hashlib
 import logging
+import os
 import sys
 
 # Configure logging to output to stdout with a specific format
 logging.basicConfig(
-    level=logging.DEBUG,  # Set to DEBUG for more verbose output
+    level=os.getenv("LOG_LEVEL", "INFO"),  # Override with LOG_LEVEL=DEBUG for verbose output
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
         logging.StreamHandler(sys.stdout)
@@ -20,7 +32,36 @@ logger = logging.getLogger(__name__)
 # Test log
 logger.info("Server starting up...")
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Model provider registry: maps provider name to (model class, credentials attribute).
+# Built once at import so request handlers dispatch with a dict lookup instead of
+# re-importing provider modules per call. Importing the provider SDKs at module
+# scope (above) also warms them before uvicorn starts accepting traffic, so the
+# first request doesn't pay cold-import latency.
+PROVIDERS = {
+    'openai': (OpenAIModel, 'openai_api_key'),
+    'anthropic': (AnthropicModel, 'anthropic_api_key'),
+    'google-gla': (GeminiModel, 'google_api_key'),
+}
+
+# Maps output structure field type names to Python types, built once at import
+_FIELD_TYPES: Final[dict] = {
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': bool,
+    'list[str]': List[str],
+    'dict': Dict[str, Any],
+}
+
+# Cap in-flight upstream calls per provider so a traffic spike doesn't
+# open unbounded simultaneous connections and trip provider rate limits
+PROVIDER_SEMAPHORES = {
+    'openai': asyncio.Semaphore(int(os.getenv("OPENAI_CONC", 32))),
+    'anthropic': asyncio.Semaphore(int(os.getenv("ANTHROPIC_CONC", 32))),
+    'google-gla': asyncio.Semaphore(int(os.getenv("GOOGLE_CONC", 32))),
+}
 
 # Enable CORS
 app.add_middleware(
@@ -31,6 +72,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """GZip middleware that leaves the SSE route uncompressed.
+
+    Starlette gzips streaming responses chunk by chunk regardless of
+    minimum_size and never flushes per event, so small delta frames sit
+    in the zlib buffer and arrive coalesced — defeating the point of
+    streaming.
+    """
+    EXCLUDED_PATHS = ("/api/run-agent/stream",)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope.get("path") in self.EXCLUDED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# Compress large payloads (generated code, structured outputs); small
+# responses pass through untouched and the SSE stream stays uncompressed
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024)
+
 class OutputField(BaseModel):
     name: str
     type: str
@@ -80,116 +141,147 @@ class AgentRunRequest(BaseModel):
 
 class AgentRunResponse(BaseModel):
     """Response model for agent execution"""
+    # The handler builds this from data it already validated; skip the
+    # copy/re-validation pass Pydantic would otherwise run on instances
+    model_config = ConfigDict(arbitrary_types_allowed=True, revalidate_instances='never')
+
     result: str
     structured_output: Optional[Dict[str, Any]] = None
     usage: Optional[dict] = None
     error: Optional[str] = None
 
-def create_output_model(output_structure: OutputStructure):
-    """Dynamically create a Pydantic model from output structure"""
-    field_types = {
-        'str': str,
-        'int': int,
-        'float': float,
-        'bool': bool,
-        'list[str]': List[str],
-        'dict': Dict[str, Any],
-    }
-    
+@lru_cache(maxsize=512)
+def _build_output_model(name: str, fields_key: tuple):
+    """Build (and cache) a dynamic Pydantic model for a given schema.
+
+    create_model compiles validators on every call, which is expensive;
+    caching on the hashable (name, fields) key lets identical output
+    structures reuse the same compiled model.
+    """
     fields = {
-        field.name: (
-            field_types.get(field.type, Any),
-            Field(..., description=field.description or "")
+        field_name: (
+            _FIELD_TYPES.get(field_type, Any),
+            Field(..., description=description)
         )
-        for field in output_structure.fields
+        for field_name, field_type, description in fields_key
     }
-    
-    return create_model(output_structure.name, **fields)
 
-@app.post("/api/run-agent", response_model=AgentRunResponse)
-async def run_agent(request: AgentRunRequest) -> AgentRunResponse:
+    return create_model(name, **fields)
+
+def create_output_model(output_structure: OutputStructure):
+    """Dynamically create a Pydantic model from output structure"""
+    fields_key = tuple(
+        (field.name, str(field.type), field.description or "")
+        for field in output_structure.fields
+    )
+    return _build_output_model(output_structure.name, fields_key)
+
+def _dump(obj):
+    """Serialize a Pydantic model (or plain object) to a dict of primitives.
+
+    model_dump handles computed fields and nested models, which __dict__
+    misses; for non-Pydantic objects fall back to __dict__.
+    """
+    if obj is None:
+        return None
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    return obj.__dict__
+
+@lru_cache(maxsize=128)
+def get_agent(provider: str, model_name: str, api_key: str, system_prompt: str, result_type):
+    """Build (and cache) an Agent for the given configuration.
+
+    Agents own an HTTP client, so reusing them across requests keeps
+    connections alive instead of re-creating TLS state per call.
+    result_type is either str or a model class from create_output_model,
+    which is itself cached, so identical schemas hash to the same key.
+    """
+    model_cls, _ = PROVIDERS[provider]
+    model = model_cls(model_name, api_key=api_key)
+    return Agent(
+        model,
+        system_prompt=system_prompt,
+        result_type=result_type,
+    )
+
+# AgentRunResponse is kept in the OpenAPI schema via `responses`, but the
+# handler returns a plain dict so FastAPI skips the second validation pass
+# it would run on a response_model. response_model=None is explicit because
+# FastAPI would otherwise infer one from the return annotation.
+@app.post("/api/run-agent", response_model=None, responses={200: {"model": AgentRunResponse}})
+async def run_agent(request: AgentRunRequest) -> Dict[str, Any]:
     try:
         logger.info("Received agent run request")
-        logger.debug(f"Request config: {request.config}")
-        logger.debug(f"Request prompt: {request.prompt}")
+        logger.debug("Request config: %s", request.config)
+        logger.debug("Request prompt: %s", request.prompt)
         
-        # Get the appropriate API key based on the model provider
-        api_key = None
-        model = None
-        
-        if request.config.model_provider == 'openai':
-            from pydantic_ai.models.openai import OpenAIModel
-            api_key = request.credentials.openai_api_key
-            if not api_key:
-                raise HTTPException(status_code=400, detail="Missing OpenAI API key")
-            model = OpenAIModel(request.config.model_name, api_key=api_key)
-        elif request.config.model_provider == 'anthropic':
-            from pydantic_ai.models.anthropic import AnthropicModel
-            api_key = request.credentials.anthropic_api_key
-            if not api_key:
-                raise HTTPException(status_code=400, detail="Missing Anthropic API key")
-            model = AnthropicModel(request.config.model_name, api_key=api_key)
-        elif request.config.model_provider == 'google-gla':
-            from pydantic_ai.models.gemini import GeminiModel
-            api_key = request.credentials.google_api_key
-            if not api_key:
-                raise HTTPException(status_code=400, detail="Missing Google API key")
-            model = GeminiModel(request.config.model_name, api_key=api_key)
-        else:
+        # Look up the model class and credentials attribute for the provider
+        provider = request.config.model_provider
+        if provider not in PROVIDERS:
             raise HTTPException(
                 status_code=400,
-                detail=f"Unsupported model provider: {request.config.model_provider}"
+                detail=f"Unsupported model provider: {provider}"
             )
+        _, key_attr = PROVIDERS[provider]
+
+        api_key = getattr(request.credentials, key_attr)
+        if not api_key:
+            raise HTTPException(status_code=400, detail=f"Missing API key for provider: {provider}")
 
         # Create dynamic output model if output structure is provided
         result_type = None
         if request.config.output_structure:
             result_type = create_output_model(request.config.output_structure)
-            logger.info(f"Created dynamic output model: {result_type}")
-            
-        # Create agent with structured result type
-        agent = Agent(
-            model,
-            system_prompt=request.config.system_prompts[0] if request.config.system_prompts else "",
-            result_type=result_type or str,
+            logger.info("Created dynamic output model: %s", result_type)
+
+        # Get a cached agent for this configuration
+        agent = get_agent(
+            provider,
+            request.config.model_name,
+            api_key,
+            request.config.system_prompts[0] if request.config.system_prompts else "",
+            result_type or str,
         )
+
+        logger.info("Created agent with model %s:%s", request.config.model_provider, request.config.model_name)
         
-        logger.info(f"Created agent with model {request.config.model_provider}:{request.config.model_name}")
-        
-        # Run the agent with model settings
-        result = await agent.run(
-            request.prompt,
-            model_settings={
-                "temperature": request.config.temperature,
-                "max_tokens": request.config.max_tokens,
-                "response_tokens_limit": request.config.response_tokens_limit,
-                "total_tokens_limit": request.config.total_tokens_limit
-            }
-        )
+        # Run the agent with model settings, bounded by the provider's
+        # concurrency slot
+        async with PROVIDER_SEMAPHORES[provider]:
+            result = await agent.run(
+                request.prompt,
+                model_settings={
+                    "temperature": request.config.temperature,
+                    "max_tokens": request.config.max_tokens,
+                    "response_tokens_limit": request.config.response_tokens_limit,
+                    "total_tokens_limit": request.config.total_tokens_limit
+                }
+            )
         
         logger.info("Agent run completed")
         
         # Handle different result types
         if isinstance(result.data, str):
-            response = AgentRunResponse(
+            response = AgentRunResponse.model_construct(
                 result=result.data,
-                usage=result.usage().__dict__ if result.usage() else None
+                usage=_dump(result.usage())
             )
         elif hasattr(result.data, '__dict__'):  # Structured output
-            response = AgentRunResponse(
+            response = AgentRunResponse.model_construct(
                 result=str(result.data),  # String representation
-                structured_output=result.data.__dict__,  # Structured data
-                usage=result.usage().__dict__ if result.usage() else None
+                structured_output=_dump(result.data),  # Structured data
+                usage=_dump(result.usage())
             )
         else:
-            response = AgentRunResponse(
+            response = AgentRunResponse.model_construct(
                 result="Error: Unexpected result type",
                 error="UnexpectedResultType",
-                usage=result.usage().__dict__ if result.usage() else None
+                usage=_dump(result.usage())
             )
             
         logger.info("Returning successful response")
-        return response
+        return response.model_dump()
         
     except ValidationError as e:
         error_msg = f"Validation error: {e.json()}"
@@ -200,6 +292,62 @@ async def run_agent(request: AgentRunRequest) -> AgentRunResponse:
         logger.error(error_msg, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/run-agent/stream")
+async def run_agent_stream(request: AgentRunRequest) -> StreamingResponse:
+    """Stream an agent run as server-sent events.
+
+    Text deltas are forwarded as they arrive instead of buffering the
+    full completion, with usage emitted in a terminal event. The
+    non-streaming /api/run-agent endpoint is kept for backwards compat.
+    """
+    logger.info("Received streaming agent run request")
+
+    # Resolve provider and credentials up front so bad requests fail
+    # with a normal HTTP error before the stream starts
+    provider = request.config.model_provider
+    if provider not in PROVIDERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported model provider: {provider}"
+        )
+    _, key_attr = PROVIDERS[provider]
+
+    api_key = getattr(request.credentials, key_attr)
+    if not api_key:
+        raise HTTPException(status_code=400, detail=f"Missing API key for provider: {provider}")
+
+    result_type = None
+    if request.config.output_structure:
+        result_type = create_output_model(request.config.output_structure)
+
+    agent = get_agent(
+        provider,
+        request.config.model_name,
+        api_key,
+        request.config.system_prompts[0] if request.config.system_prompts else "",
+        result_type or str,
+    )
+
+    async def event_stream():
+        try:
+            async with PROVIDER_SEMAPHORES[provider], agent.run_stream(
+                request.prompt,
+                model_settings={
+                    "temperature": request.config.temperature,
+                    "max_tokens": request.config.max_tokens,
+                    "response_tokens_limit": request.config.response_tokens_limit,
+                    "total_tokens_limit": request.config.total_tokens_limit
+                }
+            ) as stream:
+                async for chunk in stream.stream_text(delta=True):
+                    yield f"data: {orjson.dumps({'delta': chunk}).decode()}\n\n"
+                yield f"data: {orjson.dumps({'done': True, 'usage': _dump(stream.usage())}).decode()}\n\n"
+        except Exception as e:
+            logger.error("Error streaming agent run: %s", e, exc_info=True)
+            yield f"data: {orjson.dumps({'error': str(e)}).decode()}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 class FlowNode(BaseModel):
     id: str
     type: str
@@ -215,8 +363,51 @@ class GenerateCodeRequest(BaseModel):
     nodes: List[FlowNode]
     edges: List[FlowEdge]
 
+# Maps provider names to the model class used in generated code
+_MODEL_SETUP: Final[dict] = {
+    'openai': 'OpenAIModel',
+    'anthropic': 'AnthropicModel',
+    'google-gla': 'GeminiModel'
+}
+
+# Per-node template for generated flow code: one format call per node
+# instead of ~20 interim f-strings
+_NODE_TEMPLATE: Final[str] = """\
+    # {label}
+    model = {model_cls}(
+        {model_name!r},
+        api_key=credentials[{credentials_key!r}]
+    )
+
+    agent = Agent(
+        model,
+        system_prompt={system_prompt!r},
+        result_type={result_type}
+    )
+
+    {var_name} = agent.run_sync(
+        {input_construction},
+        model_settings={{
+            'temperature': {temperature},
+            'max_tokens': {max_tokens},
+            'response_tokens_limit': {response_tokens_limit},
+            'total_tokens_limit': {total_tokens_limit}
+        }}
+    ).data
+
+    results.append({{
+        'node_id': {node_id!r},
+        'result': {var_name}
+    }})
+
+"""
+
+def _identifier(node_id: str) -> str:
+    """Reduce a node id to something safe to embed in a variable name"""
+    return re.sub(r'\W', '_', node_id)
+
 def generate_python_code(nodes: List[FlowNode], edges: List[FlowEdge]) -> str:
-    code = [
+    header = [
         "from typing import Optional, List, Dict, Any, Union",
         "from pydantic import BaseModel, Field",
         "from pydantic_ai import Agent",
@@ -234,101 +425,103 @@ def generate_python_code(nodes: List[FlowNode], edges: List[FlowEdge]) -> str:
             for field in node.config.output_structure.fields:
                 field_str = f"    {field.name}: {field.type}"
                 if field.description:
-                    field_str += f' = Field(description="{field.description}")'
+                    field_str += f' = Field(description={field.description!r})'
                 fields.append(field_str)
                 
-            code.extend([
+            header.extend([
                 f"class {node.config.output_structure.name}(BaseModel):",
                 *fields,
                 ""
             ])
     
     # Generate the main flow execution code
-    code.extend([
+    header.extend([
         "def run_flow(prompt: str, credentials: dict) -> List[Dict[str, Any]]:",
         "    results = []",
         "",
     ])
+
+    # Each entry is one fully formatted block; joined once at the end
+    code_parts = ["\n".join(header) + "\n"]
     
     # Create a dictionary of node IDs to their output variables
     node_outputs = {}
     
-    # Process nodes in order based on edges
-    processed_nodes = set()
+    # Process nodes in topological order with Kahn's algorithm: a single
+    # O(N+E) pass instead of repeatedly re-scanning all nodes and edges
     nodes_by_id = {node.id: node for node in nodes}
+
+    in_degree = {node.id: 0 for node in nodes}
+    children = defaultdict(list)
+    inputs_by_target = defaultdict(list)
+    for edge in edges:
+        # Ignore stale edges pointing at deleted nodes; they contribute
+        # nothing to the generated flow
+        if edge.source not in nodes_by_id or edge.target not in nodes_by_id:
+            continue
+        in_degree[edge.target] += 1
+        children[edge.source].append(edge.target)
+        inputs_by_target[edge.target].append(edge.source)
+
+    queue = deque(node.id for node in nodes if in_degree[node.id] == 0)
+    processed_count = 0
+
+    while queue:
+        node = nodes_by_id[queue.popleft()]
+        processed_count += 1
+
+        input_nodes = inputs_by_target.get(node.id, ())
+
+        var_name = f"result_{_identifier(node.id)}"
+        node_outputs[node.id] = var_name
+        
+        # Get model setup code
+        model_setup = _MODEL_SETUP[node.config.model_provider]
+        
+        # Get input construction
+        input_construction = "prompt"
+        if input_nodes:
+            selected_fields = []
+            for input_id in input_nodes:
+                input_node = nodes_by_id[input_id]
+                if input_node.config.selected_output_fields:
+                    for field in input_node.config.selected_output_fields:
+                        selected_fields.append(f"{node_outputs[input_id]}.{field}")
+            if selected_fields:
+                input_construction = f"prompt + '\\n\\nContext: ' + ' '.join([str(x) for x in [{', '.join(selected_fields)}]])"
+        
+        # Generate agent code
+        result_type = "str"
+        if node.config.output_structure:
+            result_type = node.config.output_structure.name
+        
+        code_parts.append(_NODE_TEMPLATE.format(
+            # keep the label on one comment line; a newline here would
+            # inject statements into the generated source
+            label=" ".join(node.config.label.split()),
+            model_cls=model_setup,
+            model_name=node.config.model_name,
+            credentials_key=f"{node.config.model_provider}_api_key",
+            system_prompt=node.config.system_prompts[0] if node.config.system_prompts else '',
+            result_type=result_type,
+            var_name=var_name,
+            input_construction=input_construction,
+            temperature=node.config.temperature,
+            max_tokens=node.config.max_tokens,
+            response_tokens_limit=node.config.response_tokens_limit,
+            total_tokens_limit=node.config.total_tokens_limit,
+            node_id=node.id,
+        ))
+        
+        for child in children[node.id]:
+            in_degree[child] -= 1
+            if in_degree[child] == 0:
+                queue.append(child)
+
+    if processed_count < len(nodes):
+        raise ValueError("Flow graph contains a cycle")
     
-    def get_input_nodes(node_id: str) -> List[str]:
-        return [edge.source for edge in edges if edge.target == node_id]
-    
-    while len(processed_nodes) < len(nodes):
-        for node in nodes:
-            if node.id in processed_nodes:
-                continue
-                
-            input_nodes = get_input_nodes(node.id)
-            if not all(n in processed_nodes for n in input_nodes):
-                continue
-            
-            var_name = f"result_{node.id}"
-            node_outputs[node.id] = var_name
-            
-            # Get model setup code
-            model_setup = {
-                'openai': 'OpenAIModel',
-                'anthropic': 'AnthropicModel',
-                'google-gla': 'GeminiModel'
-            }[node.config.model_provider]
-            
-            # Get input construction
-            input_construction = "prompt"
-            if input_nodes:
-                selected_fields = []
-                for input_id in input_nodes:
-                    input_node = nodes_by_id[input_id]
-                    if input_node.config.selectedOutputFields:
-                        for field in input_node.config.selectedOutputFields:
-                            selected_fields.append(f"{node_outputs[input_id]}.{field}")
-                if selected_fields:
-                    input_construction = f"prompt + '\\n\\nContext: ' + ' '.join([str(x) for x in [{', '.join(selected_fields)}]])"
-            
-            # Generate agent code
-            result_type = "str"
-            if node.config.output_structure:
-                result_type = node.config.output_structure.name
-            
-            code.extend([
-                f"    # {node.config.label}",
-                f"    model = {model_setup}(",
-                f"        '{node.config.model_name}',",
-                f"        api_key=credentials['{node.config.model_provider}_api_key']",
-                "    )",
-                "",
-                f"    agent = Agent(",
-                "        model,",
-                f"        system_prompt='{node.config.systemPrompts[0] if node.config.systemPrompts else ''}',",
-                f"        result_type={result_type}",
-                "    )",
-                "",
-                f"    {var_name} = agent.run_sync(",
-                f"        {input_construction},",
-                "        model_settings={",
-                f"            'temperature': {node.config.temperature},",
-                f"            'max_tokens': {node.config.maxTokens},",
-                f"            'response_tokens_limit': {node.config.responseTokensLimit},",
-                f"            'total_tokens_limit': {node.config.totalTokensLimit}",
-                "        }",
-                "    ).data",
-                "",
-                f"    results.append({{",
-                f"        'node_id': '{node.id}',",
-                f"        'result': {var_name}",
-                "    })",
-                ""
-            ])
-            
-            processed_nodes.add(node.id)
-    
-    code.extend([
+    code_parts.append("\n".join([
         "    return results",
         "",
         "if __name__ == '__main__':",
@@ -343,24 +536,52 @@ def generate_python_code(nodes: List[FlowNode], edges: List[FlowEdge]) -> str:
         "        print(f\"Node {result['node_id']} output:\")",
         "        print(result['result'])",
         ""
-    ])
+    ]))
     
-    return "\n".join(code)
+    return "".join(code_parts)
+
+# Generated code keyed by a content hash of the flow graph; users often
+# regenerate against an unchanged graph, so serve those hits instantly
+_CODEGEN_CACHE: Dict[bytes, str] = {}
+_CODEGEN_CACHE_MAX = 256
+
+def _codegen_cache_key(nodes: List[FlowNode], edges: List[FlowEdge]) -> bytes:
+    payload = [n.model_dump() for n in nodes] + [e.model_dump() for e in edges]
+    return hashlib.blake2b(orjson.dumps(payload)).digest()
 
 @app.post("/api/generate-code")
 async def generate_code(request: GenerateCodeRequest) -> Dict[str, str]:
     try:
-        code = generate_python_code(request.nodes, request.edges)
+        key = _codegen_cache_key(request.nodes, request.edges)
+        code = _CODEGEN_CACHE.get(key)
+        if code is None:
+            # Codegen is pure-CPU string building; run it in a thread so the
+            # event loop keeps servicing concurrent agent calls
+            code = await asyncio.to_thread(generate_python_code, request.nodes, request.edges)
+            if len(_CODEGEN_CACHE) >= _CODEGEN_CACHE_MAX:
+                # Evict the oldest entry (dicts preserve insertion order)
+                _CODEGEN_CACHE.pop(next(iter(_CODEGEN_CACHE)))
+            _CODEGEN_CACHE[key] = code
         return {"code": code}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     logger.info("Starting server...")
+    # uvloop/httptools swap the pure-Python event loop and HTTP parser for
+    # C implementations. reload=True is for development and disables
+    # workers; in production run without it, e.g.:
+    #   WEB_CONCURRENCY=4 uvicorn server:app --host 0.0.0.0 --port 8000 \
+    #       --loop uvloop --http httptools
     uvicorn.run(
         "server:app",
         host="0.0.0.0",
         port=8000,
         reload=True,
-        log_level="debug"
-    ) 
\ No newline at end of file
+        log_level="debug",
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+        limit_concurrency=1000,
+        timeout_keep_alive=30
+    )
\ No newline at end of file